@@ -1,6 +1,8 @@
 import configparser
 import psycopg2
-from sql_queries import *
+from sql_queries import songplays_per_artist,\
+                        songplays_per_user_level,\
+                        execute
 
 def main():
     config = configparser.ConfigParser()
@@ -11,12 +13,18 @@ def main():
     cur = conn.cursor()
 
 
-    cur.execute(songplays_per_artist)
+    execute(cur, songplays_per_artist)
     results = cur.fetchall()
     print("The five artists with most songs played:")
     for row in results:
         print(f"{row}")
 
+    execute(cur, songplays_per_user_level)
+    results = cur.fetchall()
+    print("\nPlays and listeners per subscription level at the time of play:")
+    for row in results:
+        print(f"{row}")
+
     conn.close()
 
 
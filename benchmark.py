@@ -0,0 +1,267 @@
+import argparse
+import configparser
+import math
+import random
+import threading
+import time
+import psycopg2
+from sql_queries import top_artists_in_year,\
+                        plays_per_hour_on_weekday,\
+                        user_listening_history,\
+                        level_share_in_month,\
+                        top_songs_for_gender,\
+                        execute
+
+# QUERY CATALOG
+# Every query is parameterized. The parameter names refer to the value
+# pools collected by 'sample_parameters', so each run replays realistic
+# dashboard filters instead of one fixed query. Every client prepares each
+# query once on its connection.
+
+benchmark_queries = [top_artists_in_year,
+                     plays_per_hour_on_weekday,
+                     user_listening_history,
+                     level_share_in_month,
+                     top_songs_for_gender]
+
+parameter_samples = {
+    'year': "SELECT DISTINCT year FROM time;",
+    'weekday': "SELECT DISTINCT weekday FROM time;",
+    'month': "SELECT DISTINCT month FROM time;",
+    'user_id': "SELECT DISTINCT user_id FROM songplays LIMIT 500;",
+    'gender': "SELECT DISTINCT gender FROM users WHERE gender IS NOT NULL;",
+}
+
+# SCHEMA VARIANTS
+# Each variant is materialized as a copy of the star schema in its own
+# schema. On the local Postgres stand-in the SORTKEY becomes a clustered
+# index and the distribution settings are ignored.
+
+schema_variants = {
+    'song_dist': {
+        'songplays': {'distkey': 'song_id', 'sortkey': 'songplay_id'},
+        'users': {'diststyle': 'ALL', 'sortkey': 'user_id, valid_from'},
+        'songs': {'distkey': 'song_id', 'sortkey': 'song_id'},
+        'artists': {'diststyle': 'ALL', 'sortkey': 'artist_id'},
+        'time': {'diststyle': 'ALL', 'sortkey': 'start_time'},
+    },
+    'hash_dist': {
+        'songplays': {'distkey': 'event_hash', 'sortkey': 'event_hash'},
+        'users': {'diststyle': 'ALL', 'sortkey': 'user_id, valid_from'},
+        'songs': {'diststyle': 'ALL', 'sortkey': 'song_id'},
+        'artists': {'diststyle': 'ALL', 'sortkey': 'artist_id'},
+        'time': {'diststyle': 'ALL', 'sortkey': 'start_time'},
+    },
+    'time_sorted': {
+        'songplays': {'distkey': 'user_id', 'sortkey': 'start_time'},
+        'users': {'diststyle': 'ALL', 'sortkey': 'user_id, valid_from'},
+        'songs': {'diststyle': 'ALL', 'sortkey': 'song_id'},
+        'artists': {'diststyle': 'ALL', 'sortkey': 'artist_id'},
+        'time': {'diststyle': 'ALL', 'sortkey': 'start_time'},
+    },
+}
+
+
+def variant_ddl(variant, target):
+    """Return the statements that materialize a schema variant."""
+    schema = f"bench_{variant}"
+    statements = [f"DROP SCHEMA IF EXISTS {schema} CASCADE;",
+                  f"CREATE SCHEMA {schema};"]
+    for table, layout in schema_variants[variant].items():
+        sortkey = layout['sortkey']
+        if target == 'redshift':
+            if 'distkey' in layout:
+                distribution = f"DISTKEY({layout['distkey']})"
+            else:
+                distribution = f"DISTSTYLE {layout['diststyle']}"
+            statements.append(
+                f"CREATE TABLE {schema}.{table} {distribution} "
+                f"SORTKEY({sortkey}) AS SELECT * FROM public.{table};")
+        else:
+            statements += [
+                f"CREATE TABLE {schema}.{table} "
+                f"AS SELECT * FROM public.{table};",
+                f"CREATE INDEX {table}_sortkey_idx "
+                f"ON {schema}.{table} ({sortkey});",
+                f"CLUSTER {schema}.{table} USING {table}_sortkey_idx;"]
+        statements.append(f"ANALYZE {schema}.{table};")
+    return statements
+
+
+def create_variants(cur, conn, variants, target):
+    """Copy the star schema into one schema per variant."""
+    for variant in variants:
+        print(f"Creating schema variant '{variant}'.")
+        for query in variant_ddl(variant, target):
+            cur.execute(query)
+        conn.commit()
+
+
+def drop_variants(cur, conn, variants):
+    """Drop the schemas created for the benchmark."""
+    for variant in variants:
+        cur.execute(f"DROP SCHEMA IF EXISTS bench_{variant} CASCADE;")
+    conn.commit()
+
+
+def sample_parameters(cur):
+    """Collect the parameter values the clients draw from."""
+    samples = {}
+    for name, query in parameter_samples.items():
+        cur.execute(query)
+        samples[name] = [row[0] for row in cur.fetchall()]
+        if not samples[name]:
+            raise ValueError(f"No values found for parameter '{name}'. "
+                             "Load the star schema before benchmarking.")
+    return samples
+
+
+def run_client(dsn, schema, samples, deadline, seed, timings, errors, lock):
+    """Replay random catalog queries until the deadline is reached.
+
+    The timings collected so far are kept even if the client fails; the
+    failure itself is appended to 'errors'.
+    """
+    rng = random.Random(seed)
+    local_timings = []
+    conn = None
+    try:
+        conn = psycopg2.connect(dsn)
+        cur = conn.cursor()
+        cur.execute(f"SET search_path TO {schema}, public;")
+        conn.commit()
+
+        while time.perf_counter() < deadline:
+            query = rng.choice(benchmark_queries)
+            params = {name: rng.choice(samples[name])
+                      for name in query.param_names}
+            start = time.perf_counter()
+            execute(cur, query, **params)
+            cur.fetchall()
+            local_timings.append((query.name, time.perf_counter() - start))
+        conn.rollback()
+    except Exception as e:
+        with lock:
+            errors.append(f"client {seed}: {e!r}")
+    finally:
+        if conn is not None:
+            conn.close()
+        with lock:
+            timings.extend(local_timings)
+
+
+def percentile(values, pct):
+    """Return the nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(len(ordered) * pct / 100))
+    return ordered[rank - 1]
+
+
+def run_variant(dsn, variant, samples, clients, duration):
+    """Run the workload against one variant and summarize the timings."""
+    timings = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    threads = [threading.Thread(target=run_client,
+                                args=(dsn, f"bench_{variant}", samples,
+                                      deadline, seed, timings, errors, lock))
+               for seed in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise RuntimeError(f"{len(errors)} of {clients} clients failed on "
+                           f"'{variant}':\n" + "\n".join(errors))
+
+    summary = {'throughput': len(timings) / duration, 'queries': {}}
+    for query in benchmark_queries:
+        latencies = [latency for name, latency in timings
+                     if name == query.name]
+        if latencies:
+            summary['queries'][query.name] = {
+                'count': len(latencies),
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99)}
+    return summary
+
+
+def print_report(results, clients, duration):
+    """Print throughput and latency percentiles for all variants."""
+    variants = list(results)
+    print(f"\n{clients} clients, {duration} seconds per variant.\n")
+    header = f"{'query':<28}" + "".join(
+        f"| {variant + ' p50/p95/p99 ms':<34}" for variant in variants)
+    print(header)
+    print("-" * len(header))
+    for query in benchmark_queries:
+        row = f"{query.name:<28}"
+        for variant in variants:
+            stats = results[variant]['queries'].get(query.name)
+            if stats:
+                cell = "{:.1f} / {:.1f} / {:.1f} (n={})".format(
+                    stats['p50'] * 1000, stats['p95'] * 1000,
+                    stats['p99'] * 1000, stats['count'])
+            else:
+                cell = "no samples"
+            row += f"| {cell:<34}"
+        print(row)
+    print("-" * len(header))
+    row = f"{'throughput (queries/s)':<28}"
+    for variant in variants:
+        row += f"| {results[variant]['throughput']:<34.1f}"
+    print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay the analytic query catalog with concurrent "
+                    "clients against several schema variants.")
+    parser.add_argument('--dsn',
+                        help="Connection string. Required for Postgres, "
+                             "defaults to the cluster in 'dwh.cfg' for "
+                             "Redshift.")
+    parser.add_argument('--target', choices=['postgres', 'redshift'],
+                        default='postgres')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--variants', nargs='+',
+                        choices=sorted(schema_variants),
+                        default=sorted(schema_variants))
+    parser.add_argument('--keep', action='store_true',
+                        help="Keep the variant schemas after the run.")
+    args = parser.parse_args()
+    if args.target == 'postgres' and not args.dsn:
+        parser.error("--dsn is required for --target postgres.")
+
+    dsn = args.dsn
+    if not dsn:
+        config = configparser.ConfigParser()
+        config.read('dwh.cfg')
+        dsn = "host={} dbname={} user={} password={} port={}"\
+              .format(*config['CLUSTER'].values())
+
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    samples = sample_parameters(cur)
+    create_variants(cur, conn, args.variants, args.target)
+
+    results = {}
+    try:
+        for variant in args.variants:
+            print(f"Running workload against '{variant}'.")
+            results[variant] = run_variant(dsn, variant, samples,
+                                           args.clients, args.duration)
+    finally:
+        if not args.keep:
+            drop_variants(cur, conn, args.variants)
+        conn.close()
+
+    print_report(results, args.clients, args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import os
+import uuid
+import pytest
+
+# Tests that run SQL need a Postgres database, e.g.
+# SPARKIFY_TEST_DSN="host=localhost dbname=sparkify user=postgres".
+# Each test gets its own schema, which is dropped afterwards.
+
+
+@pytest.fixture
+def postgres():
+    dsn = os.environ.get('SPARKIFY_TEST_DSN')
+    if not dsn:
+        pytest.skip("SPARKIFY_TEST_DSN is not set.")
+    psycopg2 = pytest.importorskip('psycopg2')
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    schema = f"test_{uuid.uuid4().hex}"
+    cur.execute(f"CREATE SCHEMA {schema};")
+    cur.execute(f"SET search_path TO {schema};")
+    conn.commit()
+    try:
+        yield conn, cur
+    finally:
+        conn.rollback()
+        cur.execute(f"DROP SCHEMA {schema} CASCADE;")
+        conn.commit()
+        conn.close()
@@ -6,7 +6,8 @@ import time
 import sys
 from sql_queries import create_table_queries,\
                         drop_table_queries,\
-                        scan_existing_tables
+                        scan_existing_tables,\
+                        execute
 from botocore.exceptions import ClientError
 
 def create_iam_role(iam, IAM_ROLE_NAME):
@@ -144,13 +145,12 @@ def create_cluster(config):
 def drop_tables(cur, conn):
     """Drop all existing tables if there are any."""
     print("3.1 Checking for existing tables.")
-    cur.execute(scan_existing_tables)
+    execute(cur, scan_existing_tables)
     results = cur.fetchall()
     if results:
         for query in drop_table_queries:
-            table = query.split(" ")[4]
-            print(f"Dropping table '{table}'.")
-            cur.execute(query)
+            print(f"Dropping table '{query.table}'.")
+            execute(cur, query)
             conn.commit()
             print("Table dropped.")
         print()
@@ -162,9 +162,8 @@ def create_tables(cur, conn):
     """Create staging and star schema tables."""
     print("3.2 Creating tables for staging and star schema.")
     for query in create_table_queries:
-        table = query.split(" ")[5]
-        print(f"Creating table '{table}'.")
-        cur.execute(query)
+        print(f"Creating table '{query.table}'.")
+        execute(cur, query)
         conn.commit()
     print()
 
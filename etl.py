@@ -1,87 +1,114 @@
 import configparser
 import psycopg2
 import time
-from sql_queries import *
+from sql_queries import truncate_table_queries,\
+                        copy_table_queries,\
+                        insert_table_queries,\
+                        check_duplicates_queries,\
+                        drop_staging_tables_queries,\
+                        staging_events_hash,\
+                        songplays_sort,\
+                        detect_year_zero,\
+                        set_year_null,\
+                        artists_remove_duplicates,\
+                        execute
+from quarantine import copy_errors, write_quarantine
 
 def truncate_tables(cur, conn):
     """Truncate all tables."""
     for query in truncate_table_queries:
-        table = query.split(" ")[2]
-        print(f"Do you want to truncate table '{table}'?")
+        print(f"Do you want to truncate table '{query.table}'?")
         decision = input("[y/n] > ")
         if decision.lower() == "y":
-            cur.execute(query)
+            execute(cur, query)
             conn.commit()
-            print(f"Table '{table}' truncated.")
+            print(f"Table '{query.table}' truncated.")
         else:
             continue
     print()
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(cur, conn, config, quarantine_path):
+    """Copy the source data and quarantine the lines COPY rejected."""
     print("4.1 Copying data to the staging tables.")
     for query in copy_table_queries:
-        table = query.split(" ")[1]
-        print(f"\nCopying data into '{table}' table.")
-        cur.execute(query)
+        print(f"\nCopying data into '{query.table}' table.")
+        execute(cur, query, config)
         conn.commit()
         print(f"Data copied.")
+        errors = copy_errors(cur)
+        if errors:
+            write_quarantine(cur, conn, query.table, errors, quarantine_path)
     print("\nAll tables copied.\n")
 
 
-def insert_tables(cur, conn):
-    print("4.2 Inserting data into star schema.")
+def hash_staging_events(cur, conn):
+    """Give every staged event its content hash, sorted by that hash."""
+    print("4.2 Hashing staged events.")
+    execute(cur, staging_events_hash)
+    conn.commit()
+    print("Staged events hashed and sorted.\n")
+
+
+def insert_tables(cur, conn, dialect='redshift'):
+    print("4.3 Inserting data into star schema.")
     for query in insert_table_queries:
-        table = query.split(" ")[2]
-        print(f"\nInserting data into '{table}' table.")
-        cur.execute(query)
+        print(f"\nInserting data into '{query.table}' table.")
+        execute(cur, query, dialect=dialect)
         conn.commit()
         print("Insert complete.")
     print("\nAll data has been inserted to star schema.\n")
 
 
+def sort_songplays(cur, conn):
+    """Sort the rows just inserted into songplays."""
+    print("4.4 Sorting songplays.")
+    # VACUUM cannot run inside a transaction block.
+    conn.autocommit = True
+    try:
+        execute(cur, songplays_sort)
+    finally:
+        conn.autocommit = False
+    print("Songplays sorted.\n")
+
+
 def clean_data(cur, conn):
     """Set year-column in songs-table to NULL where '0'."""
-    cur.execute(detect_year_zero)
+    execute(cur, detect_year_zero)
     results = cur.fetchall()
     if results:
         print("In the 'songs'-table there are some records with 'year' = '0'.\n"
               "Should we set those fields to 'NULL'?")
         decision = input("[y/n] > ")
         if decision.lower() == "y":
-            cur.execute(set_year_null)
+            execute(cur, set_year_null)
             conn.commit()
             print("Done.\n")
         else:
             print("Leaving year=0 as it is.\n")
 
 
-def check_for_duplicates(cur, conn):
+def check_for_duplicates(cur, conn, dialect='redshift'):
     """Check each star schema table for duplicates."""
-    tables = {0: "users",
-              1: "songs",
-              2: "artists",
-              3: "time",
-              4: "songplays"}
     print("5.1 Checking for duplicates.\n")
-    for index, query in enumerate(check_duplicates_queries):
-        table = tables.get(index, 'None')
+    for query in check_duplicates_queries:
+        table = query.table
         print(f"Checking for duplicates in table '{table}'.")
-        cur.execute(query)
+        execute(cur, query, dialect=dialect)
         results = cur.fetchall()
         if results:
             print(f"Table '{table}' has duplicates.")
-            kick_duplicates(cur, conn, table)
+            kick_duplicates(cur, conn, table, dialect)
         else:
             print(f"Table '{table}' has no duplicates.\n")
             continue
 
 
-def kick_duplicates(cur, conn, tablename):
+def kick_duplicates(cur, conn, tablename, dialect='redshift'):
     """Identify and remove duplicates from table."""
     if tablename == "artists":
         print(f"5.2 Removing duplicates from {tablename} table.")
-        cur.execute(artists_remove_duplicates)
+        execute(cur, artists_remove_duplicates, dialect=dialect)
         conn.commit()
         print("Duplicates removed.\n")
     else:
@@ -94,10 +121,9 @@ def drop_staging_tables(cur, conn):
     print("6.1 Do you want to drop both staging_tables?")
     decision = input("[y / n] > ")
     if decision.lower() == "y":
-        for query in drop_staging_table_queries:
-            table = query.split(" ")[4]
-            print(f"Dropping table '{table}'.")
-            cur.execute(query)
+        for query in drop_staging_tables_queries:
+            print(f"Dropping table '{query.table}'.")
+            execute(cur, query)
             conn.commit()
             print("Table dropped.")
     else:
@@ -115,9 +141,13 @@ def main():
     # Run 'truncate_tables' function if data was copied
     # but not inserted correctly.
     # truncate_tables(cur, conn)
-    load_staging_tables(cur, conn)
+    load_staging_tables(cur, conn, config,
+                        config.get('LOAD', 'QUARANTINE_FILE',
+                                   fallback='quarantine.jsonl'))
+    hash_staging_events(cur, conn)
 
     insert_tables(cur, conn)
+    sort_songplays(cur, conn)
     check_for_duplicates(cur, conn)
     clean_data(cur, conn)
     drop_staging_tables(cur, conn)
@@ -0,0 +1,300 @@
+import argparse
+import configparser
+import json
+import re
+import psycopg2
+from psycopg2.extras import execute_values
+from etl import insert_tables, sort_songplays, check_for_duplicates
+from s3_cache import cache_from_config, parse_s3_uri
+from quarantine import write_quarantine,\
+                       pending_records,\
+                       mark_reprocessed,\
+                       update_reason
+from sql_queries import staging_events_hash,\
+                        staging_events_table_create,\
+                        staging_songs_table_create,\
+                        staging_events_table_truncate,\
+                        staging_songs_table_truncate,\
+                        create_table_queries,\
+                        execute
+
+# Columns of the staging tables, the JSON fields they are read from and
+# the type every non-empty value has to be converted to.
+event_columns = [('artist', 'artist', str),
+                 ('auth', 'auth', str),
+                 ('firstName', 'firstName', str),
+                 ('gender', 'gender', str),
+                 ('iteminSession', 'itemInSession', int),
+                 ('lastName', 'lastName', str),
+                 ('length', 'length', float),
+                 ('level', 'level', str),
+                 ('location', 'location', str),
+                 ('method', 'method', str),
+                 ('page', 'page', str),
+                 ('registration', 'registration', str),
+                 ('sessionId', 'sessionId', int),
+                 ('song', 'song', str),
+                 ('status', 'status', int),
+                 ('ts', 'ts', int),
+                 ('userAgent', 'userAgent', str),
+                 ('userId', 'userId', int)]
+
+song_columns = [('num_songs', 'num_songs', int),
+                ('artist_id', 'artist_id', str),
+                ('artist_latitude', 'artist_latitude', float),
+                ('artist_longitude', 'artist_longitude', float),
+                ('artist_location', 'artist_location', str),
+                ('artist_name', 'artist_name', str),
+                ('song_id', 'song_id', str),
+                ('title', 'title', str),
+                ('duration', 'duration', float),
+                ('year', 'year', int)]
+
+staging_tables = {'staging_events': event_columns,
+                  'staging_songs': song_columns}
+
+# Redshift stores a VARCHAR without length as VARCHAR(256) and counts its
+# length in bytes.
+default_varchar_length = 256
+
+integer_ranges = {'SMALLINT': 2**15,
+                  'INT': 2**31,
+                  'INTEGER': 2**31,
+                  'BIGINT': 2**63}
+
+
+def column_limits(create_query):
+    """Read the VARCHAR lengths and integer ranges of a CREATE TABLE.
+
+    Returns a dict from lower-cased column name to ('VARCHAR', max bytes)
+    or ('INTEGER', bound), where values must lie in [-bound, bound).
+    """
+    limits = {}
+    for column, sql_type, length in re.findall(
+            r"^\s*(\w+)\s+([A-Z]+)(?:\s*\((\d+)\))?",
+            create_query.sql, re.MULTILINE):
+        if sql_type == 'VARCHAR':
+            limits[column.lower()] = (
+                'VARCHAR', int(length or default_varchar_length))
+        elif sql_type in integer_ranges:
+            limits[column.lower()] = ('INTEGER', integer_ranges[sql_type])
+    return limits
+
+
+staging_limits = {
+    'staging_events': column_limits(staging_events_table_create),
+    'staging_songs': column_limits(staging_songs_table_create)}
+
+
+class RecordError(ValueError):
+    """A source line that cannot be turned into a staging row."""
+
+    def __init__(self, colname, reason):
+        super().__init__(reason)
+        self.colname = colname
+        self.reason = reason
+
+
+def check_limit(column, value, limit):
+    """Raise a RecordError if a value does not fit its column."""
+    kind, bound = limit
+    if kind == 'VARCHAR' and len(value.encode('utf-8')) > bound:
+        raise RecordError(column, f"Value for '{column}' is longer than "
+                                  f"{bound} bytes.")
+    if kind == 'INTEGER' and not -bound <= value < bound:
+        raise RecordError(column, f"Value {value} for '{column}' is out "
+                                  f"of range.")
+
+
+def parse_record(line, columns, limits):
+    """Turn one JSON record into a row for a staging table.
+
+    Every value is checked against 'limits' from 'column_limits', so a
+    line that the database would reject is quarantined instead.
+    """
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise RecordError('', f"Invalid JSON: {e}")
+    if not isinstance(record, dict):
+        raise RecordError('', "Record is not a JSON object.")
+
+    row = []
+    for column, field, convert in columns:
+        value = record.get(field)
+        # Logged-out events carry an empty string instead of a user id.
+        if value is None or value == '':
+            row.append(None)
+            continue
+        try:
+            value = convert(value)
+        except (TypeError, ValueError, OverflowError):
+            raise RecordError(column, f"Invalid {convert.__name__} value "
+                                      f"{value!r} for '{field}'.")
+        if column.lower() in limits:
+            check_limit(column, value, limits[column.lower()])
+        row.append(value)
+    return tuple(row)
+
+
+def parse_lines(body, columns, limits, filename, errors):
+    """Parse a file of newline-delimited JSON records.
+
+    Lines that cannot be parsed are appended to 'errors' in the layout of
+    STL_LOAD_ERRORS instead of failing the whole file.
+    """
+    rows = []
+    for line_number, line in enumerate(body.decode('utf-8').splitlines(),
+                                       start=1):
+        if not line.strip():
+            continue
+        try:
+            rows.append(parse_record(line, columns, limits))
+        except RecordError as e:
+            errors.append((filename, line_number, e.colname, e.reason, line))
+    return rows
+
+
+def insert_rows(cur, table, columns, rows):
+    """Insert parsed rows into a staging table."""
+    query = "INSERT INTO {} ({}) VALUES %s".format(
+        table, ", ".join(column for column, field, convert in columns))
+    execute_values(cur, query, rows)
+
+
+def load_staging_table(cur, conn, cache, uri, table, max_errors,
+                       quarantine_path):
+    """Copy all JSON files below an S3 URI into a staging table.
+
+    Up to 'max_errors' rejected lines are quarantined, like MAXERROR for
+    COPY. Beyond that the load is rolled back.
+    """
+    columns = staging_tables[table]
+    limits = staging_limits[table]
+    bucket, prefix = parse_s3_uri(uri)
+    print(f"\nLoading 's3://{bucket}/{prefix}' into '{table}' table.")
+    num_rows = 0
+    errors = []
+    for key, body in cache.iter_objects(bucket, prefix):
+        if not key.endswith('.json'):
+            continue
+        rows = parse_lines(body, columns, limits, f"s3://{bucket}/{key}",
+                           errors)
+        if len(errors) > max_errors:
+            conn.rollback()
+            raise ValueError(f"Load into '{table}' failed: more than "
+                             f"{max_errors} rejected lines.")
+        insert_rows(cur, table, columns, rows)
+        num_rows += len(rows)
+    conn.commit()
+    print(f"{num_rows} rows loaded.")
+    if errors:
+        write_quarantine(cur, conn, table, errors, quarantine_path)
+
+
+def reprocess_quarantine(cur, conn, cache, table):
+    """Load only the quarantined lines of a table into its staging table.
+
+    Every source file is read again once through the cache, so a fixed
+    source file or a fixed parser is picked up. Lines that still fail
+    stay in quarantine with their new reason.
+    """
+    columns = staging_tables[table]
+    limits = staging_limits[table]
+    line_numbers = {}
+    for filename, line_number in pending_records(cur, table):
+        line_numbers.setdefault(filename, []).append(line_number)
+
+    recovered = failed = 0
+    for filename, numbers in line_numbers.items():
+        bucket, key = parse_s3_uri(filename)
+        lines = cache.get(bucket, key).decode('utf-8').splitlines()
+        for line_number in numbers:
+            try:
+                if line_number > len(lines):
+                    raise RecordError('', f"Line {line_number} no longer "
+                                          f"exists in '{filename}'.")
+                row = parse_record(lines[line_number - 1], columns, limits)
+            except RecordError as e:
+                update_reason(cur, table, filename, line_number, e.reason)
+                failed += 1
+                continue
+            insert_rows(cur, table, columns, [row])
+            mark_reprocessed(cur, table, filename, line_number)
+            recovered += 1
+    conn.commit()
+    cache.save()
+    print(f"'{table}': {recovered} quarantined lines reprocessed, "
+          f"{failed} still failing.")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load the S3 source data into the staging tables, "
+                    "reading through the local S3 cache.")
+    parser.add_argument('--dsn',
+                        help="Connection string. Required for Postgres, "
+                             "defaults to the cluster in 'dwh.cfg' for "
+                             "Redshift.")
+    parser.add_argument('--target', choices=['postgres', 'redshift'],
+                        default='postgres')
+    parser.add_argument('--create', action='store_true',
+                        help="Create the staging and star schema tables "
+                             "first, e.g. on an empty Postgres database.")
+    parser.add_argument('--reprocess', action='store_true',
+                        help="Replace the staging data with only the "
+                             "quarantined lines and insert them into the "
+                             "star schema.")
+    args = parser.parse_args()
+    if args.target == 'postgres' and not args.dsn:
+        parser.error("--dsn is required for --target postgres.")
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    dsn = args.dsn or "host={} dbname={} user={} password={} port={}"\
+                      .format(*config['CLUSTER'].values())
+    max_errors = config.getint('LOAD', 'MAXERROR', fallback=0)
+    quarantine_path = config.get('LOAD', 'QUARANTINE_FILE',
+                                 fallback='quarantine.jsonl')
+
+    cache = cache_from_config(config)
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+
+    if args.create:
+        for query in create_table_queries:
+            execute(cur, query, dialect=args.target)
+        conn.commit()
+        print("Tables created.")
+
+    if args.reprocess:
+        for query in [staging_events_table_create,
+                      staging_songs_table_create,
+                      staging_events_table_truncate,
+                      staging_songs_table_truncate]:
+            execute(cur, query, dialect=args.target)
+        conn.commit()
+        for table in staging_tables:
+            reprocess_quarantine(cur, conn, cache, table)
+    else:
+        load_staging_table(cur, conn, cache, config.get('S3', 'LOG_DATA'),
+                           'staging_events', max_errors, quarantine_path)
+        load_staging_table(cur, conn, cache, config.get('S3', 'SONG_DATA'),
+                           'staging_songs', max_errors, quarantine_path)
+
+    # staged_events is a temporary table, so the star schema has to be
+    # filled in the same session.
+    execute(cur, staging_events_hash, dialect=args.target)
+    conn.commit()
+    print("\nStaged events hashed.")
+
+    insert_tables(cur, conn, args.target)
+    if args.target == 'redshift':
+        sort_songplays(cur, conn)
+    check_for_duplicates(cur, conn, args.target)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import datetime
+import json
+from sql_queries import copy_load_errors,\
+                        quarantine_insert,\
+                        quarantine_pending,\
+                        quarantine_mark_reprocessed,\
+                        quarantine_update_reason,\
+                        execute
+
+
+def copy_errors(cur):
+    """Return the lines rejected by the last COPY of this session."""
+    execute(cur, copy_load_errors)
+    return cur.fetchall()
+
+
+def write_quarantine(cur, conn, table, errors, path):
+    """Store rejected lines in the quarantine table and file.
+
+    Each error is a tuple of filename, line number, column name, reason
+    and raw line, in the layout of STL_LOAD_ERRORS.
+    """
+    quarantined_at = datetime.datetime.utcnow()
+    with open(path, 'a') as quarantine_file:
+        for filename, line_number, colname, reason, raw_line in errors:
+            execute(cur, quarantine_insert,
+                    table_name=table,
+                    filename=filename,
+                    line_number=line_number,
+                    colname=colname,
+                    err_reason=reason[:256],
+                    raw_line=raw_line,
+                    quarantined_at=quarantined_at)
+            quarantine_file.write(json.dumps(
+                {'table': table,
+                 'filename': filename,
+                 'line_number': line_number,
+                 'colname': colname,
+                 'reason': reason,
+                 'raw_line': raw_line,
+                 'quarantined_at': quarantined_at.isoformat()}) + "\n")
+    conn.commit()
+    print(f"{len(errors)} rejected lines of '{table}' written to "
+          f"'load_errors_quarantine' and '{path}'.")
+
+
+def pending_records(cur, table):
+    """Return filename and line number of unprocessed quarantined lines."""
+    execute(cur, quarantine_pending, table_name=table)
+    return cur.fetchall()
+
+
+def mark_reprocessed(cur, table, filename, line_number):
+    """Flag a quarantined line as successfully reprocessed."""
+    execute(cur, quarantine_mark_reprocessed,
+            table_name=table, filename=filename, line_number=line_number)
+
+
+def update_reason(cur, table, filename, line_number, reason):
+    """Replace the reason of a line that failed again."""
+    execute(cur, quarantine_update_reason,
+            err_reason=reason[:256], table_name=table,
+            filename=filename, line_number=line_number)
@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import configparser
+import json
+import asyncpg
+from aiohttp import web
+from sql_queries import analytic_queries
+
+
+class QueryService:
+    """Run named analytic queries on a shared connection pool.
+
+    At most 'slots' queries run at the same time, matching the WLM slots
+    of the queue the service connects to. Identical requests that arrive
+    while a query is still running share its execution and result.
+    asyncpg prepares every statement once per pooled connection and
+    reuses it for later executions.
+    """
+
+    def __init__(self, pool, queries, slots, timeout):
+        self.pool = pool
+        self.queries = {query.name: query for query in queries}
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(slots)
+        self._in_flight = {}
+
+    async def run(self, name, **params):
+        """Return the rows of a named query as a list of dicts."""
+        query = self.queries[name]
+        args = query.bind(**params)
+        key = (name, tuple(args))
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                asyncio.wait_for(self._execute(query, args), self.timeout))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # A client that disconnects must not cancel the query for the
+        # other clients waiting on it.
+        return await asyncio.shield(task)
+
+    async def _execute(self, query, args):
+        async with self._slots:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(query.render(), *args,
+                                        timeout=self.timeout)
+        return [dict(row) for row in rows]
+
+
+service_key = web.AppKey('service', QueryService)
+
+
+async def list_queries(request):
+    """GET /queries: names and parameters of all available queries."""
+    service = request.app[service_key]
+    return web.json_response({name: dict(query.params)
+                              for name, query in service.queries.items()})
+
+
+async def run_query(request):
+    """GET /queries/{name}?param=value: rows of one query."""
+    service = request.app[service_key]
+    name = request.match_info['name']
+    try:
+        rows = await service.run(name, **request.query)
+    except KeyError:
+        raise web.HTTPNotFound(text=f"Unknown query '{name}'.")
+    except (TypeError, ValueError) as e:
+        raise web.HTTPBadRequest(text=str(e))
+    except asyncio.TimeoutError:
+        raise web.HTTPGatewayTimeout(
+            text=f"Query '{name}' exceeded {service.timeout} seconds.")
+    return web.json_response({'query': name, 'rows': rows},
+                             dumps=lambda data: json.dumps(data, default=str))
+
+
+def create_app(service):
+    """Create the HTTP application around a QueryService."""
+    app = web.Application()
+    app[service_key] = service
+    app.router.add_get('/queries', list_queries)
+    app.router.add_get('/queries/{name}', run_query)
+    return app
+
+
+async def serve(config, dsn):
+    """Open the connection pool and serve until interrupted."""
+    slots = config.getint('SERVICE', 'WLM_SLOTS', fallback=5)
+    pool = await asyncpg.create_pool(dsn, min_size=1, max_size=slots)
+
+    service = QueryService(pool,
+                           analytic_queries,
+                           slots,
+                           config.getfloat('SERVICE', 'QUERY_TIMEOUT',
+                                           fallback=30))
+    runner = web.AppRunner(create_app(service))
+    await runner.setup()
+    host = config.get('SERVICE', 'HOST', fallback='127.0.0.1')
+    port = config.getint('SERVICE', 'PORT', fallback=8080)
+    await web.TCPSite(runner, host, port).start()
+    print(f"Serving {len(service.queries)} queries on http://{host}:{port}.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the analytic queries over HTTP.")
+    # asyncpg does not support Redshift, so there is no default to the
+    # cluster in 'dwh.cfg'.
+    parser.add_argument('--dsn', required=True,
+                        help="Postgres URL, e.g. postgresql://localhost/"
+                             "sparkify.")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    try:
+        asyncio.run(serve(config, args.dsn))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
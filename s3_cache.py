@@ -0,0 +1,223 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import time
+import boto3
+from botocore.exceptions import ClientError
+
+
+def parse_s3_uri(uri):
+    """Split an S3 URI from the config-file into bucket and prefix."""
+    uri = uri.strip().strip("'\"")
+    if not uri.startswith('s3://'):
+        raise ValueError(f"'{uri}' is not an S3 URI.")
+    bucket, _, prefix = uri[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+def cache_from_config(config):
+    """Create an S3Cache from the [CACHE] and [AWS] sections."""
+    key = config.get('AWS', 'KEY', fallback='')
+    secret = config.get('AWS', 'SECRET', fallback='')
+    if key and secret:
+        s3 = boto3.client('s3',
+                          region_name='us-west-2',
+                          aws_access_key_id=key,
+                          aws_secret_access_key=secret)
+    else:
+        s3 = boto3.client('s3', region_name='us-west-2')
+
+    return S3Cache(config.get('CACHE', 'DIR', fallback='.s3_cache'),
+                   config.getint('CACHE', 'MAX_BYTES', fallback=2**30),
+                   listing_ttl=config.getint('CACHE', 'LISTING_TTL',
+                                             fallback=3600),
+                   workers=config.getint('CACHE', 'WORKERS', fallback=16),
+                   s3=s3)
+
+
+class S3Cache:
+    """Local cache of S3 listings and object bodies.
+
+    Bodies are stored under a name derived from bucket, key and ETag, and
+    an index tracks size and last access of every cached object. Listings
+    are reused until they are older than 'listing_ttl' seconds, so reading
+    an unchanged prefix twice within that time does no network I/O.
+    Objects whose ETag changed are re-fetched with a conditional GET. As
+    soon as the cache grows beyond 'max_bytes' the least recently used
+    bodies are evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes, listing_ttl=3600, workers=16,
+                 s3=None):
+        self.s3 = s3 or boto3.client('s3')
+        self.max_bytes = max_bytes
+        self.listing_ttl = listing_ttl
+        self.workers = workers
+
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.listings_dir = os.path.join(cache_dir, 'listings')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.listings_dir, exist_ok=True)
+
+        # The index is kept in order of last access, least recent first,
+        # together with the total size of all cached bodies.
+        self._lock = threading.Lock()
+        index = self._read_json(self.index_path) or {}
+        self._index = collections.OrderedDict(
+            sorted(index.items(), key=lambda item: item[1]['last_access']))
+        self._bytes = sum(entry['size'] for entry in self._index.values())
+
+    # LISTINGS
+
+    def list_objects(self, bucket, prefix, refresh=False):
+        """Return key, ETag and size of all objects below a prefix."""
+        name = hashlib.sha256(f"{bucket}/{prefix}".encode()).hexdigest()
+        path = os.path.join(self.listings_dir, f"{name}.json")
+        listing = self._read_json(path)
+        if listing and not refresh \
+                and time.time() - listing['listed_at'] < self.listing_ttl:
+            return listing['objects']
+
+        objects = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                objects.append({'Key': item['Key'],
+                                'ETag': item['ETag'],
+                                'Size': item['Size']})
+        self._write_json(path, {'listed_at': time.time(),
+                                'objects': objects})
+        return objects
+
+    # OBJECTS
+
+    def get(self, bucket, key, etag=None):
+        """Return the body of an object, fetching it only if necessary.
+
+        With a known ETag a matching cached body is returned without any
+        request. Otherwise a cached body is revalidated with a conditional
+        GET and only downloaded again if it changed.
+        """
+        entry = self._index.get(f"{bucket}/{key}")
+        path = entry and os.path.join(self.objects_dir, entry['blob'])
+        if entry and os.path.exists(path):
+            if etag is None:
+                try:
+                    response = self.s3.get_object(Bucket=bucket, Key=key,
+                                                  IfNoneMatch=entry['etag'])
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in ('304',
+                                                           'NotModified'):
+                        raise
+                    return self._read_blob(bucket, key, path)
+                return self._store(bucket, key, response['ETag'],
+                                   response['Body'].read())
+            if entry['etag'] == etag:
+                return self._read_blob(bucket, key, path)
+
+        response = self.s3.get_object(Bucket=bucket, Key=key)
+        return self._store(bucket, key, response['ETag'],
+                           response['Body'].read())
+
+    def prefetch(self, bucket, prefix, refresh=False):
+        """Download all new or changed objects below a prefix concurrently."""
+        for key, body in self.iter_objects(bucket, prefix, refresh=refresh):
+            pass
+
+    def iter_objects(self, bucket, prefix, refresh=False):
+        """Yield key and body of all objects below a prefix.
+
+        Up to 'workers' objects are fetched ahead of the consumer, so every
+        object is read once per pass, and a cache smaller than the prefix
+        only ever holds the bodies that are still needed.
+        """
+        objects = self.list_objects(bucket, prefix, refresh=refresh)
+        # The index is saved even if the consumer stops early, so the
+        # bodies downloaded so far are found again on the next run.
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                pending = collections.deque()
+                for item in objects:
+                    pending.append((item['Key'],
+                                    pool.submit(self.get, bucket,
+                                                item['Key'], item['ETag'])))
+                    if len(pending) >= self.workers:
+                        key, future = pending.popleft()
+                        yield key, future.result()
+                while pending:
+                    key, future = pending.popleft()
+                    yield key, future.result()
+        finally:
+            self.save()
+
+    def save(self):
+        """Persist the index."""
+        with self._lock:
+            self._write_json(self.index_path, self._index)
+
+    # INTERNALS
+
+    def _read_blob(self, bucket, key, path):
+        with open(path, 'rb') as blob:
+            body = blob.read()
+        with self._lock:
+            entry = self._index.get(f"{bucket}/{key}")
+            if entry:
+                entry['last_access'] = time.time()
+                self._index.move_to_end(f"{bucket}/{key}")
+        return body
+
+    def _store(self, bucket, key, etag, body):
+        blob = hashlib.sha256(f"{bucket}/{key}/{etag}".encode()).hexdigest()
+        path = os.path.join(self.objects_dir, blob)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as tmp:
+            tmp.write(body)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            old = self._index.pop(f"{bucket}/{key}", None)
+            if old:
+                self._bytes -= old['size']
+                if old['blob'] != blob:
+                    self._remove_blob(old['blob'])
+            self._index[f"{bucket}/{key}"] = {'etag': etag,
+                                              'blob': blob,
+                                              'size': len(body),
+                                              'last_access': time.time()}
+            self._bytes += len(body)
+            self._evict()
+        return body
+
+    def _evict(self):
+        # Least recently used first. The entry just stored is the last
+        # one and is kept even if it alone exceeds 'max_bytes'.
+        while self._bytes > self.max_bytes and len(self._index) > 1:
+            name, entry = self._index.popitem(last=False)
+            self._remove_blob(entry['blob'])
+            self._bytes -= entry['size']
+
+    def _remove_blob(self, blob):
+        try:
+            os.remove(os.path.join(self.objects_dir, blob))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path) as json_file:
+                return json.load(json_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as json_file:
+            json.dump(data, json_file)
+        os.replace(tmp_path, path)
@@ -1,44 +1,217 @@
 import configparser
+import datetime
+import re
+import weakref
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+# Config values are bound when a query is executed, not at import time,
+# so this module can be imported without a populated 'dwh.cfg'.
 
-ARN = config.get('IAM_ROLE', 'ARN')
+config_values = {'ARN': ('IAM_ROLE', 'ARN', None),
+                 'LOG_DATA': ('S3', 'LOG_DATA', None),
+                 'LOG_JSONPATH': ('S3', 'LOG_JSONPATH', None),
+                 'SONG_DATA': ('S3', 'SONG_DATA', None),
+                 'MAXERROR': ('LOAD', 'MAXERROR', '0')}
+
+_config = None
+
+
+def load_config(path='dwh.cfg'):
+    """Read the config-file once and return it."""
+    global _config
+    if _config is None:
+        _config = configparser.ConfigParser()
+        _config.read(path)
+    return _config
+
+
+# DIALECTS
+# All statements are written for Redshift. For a local Postgres stand-in
+# the Redshift table attributes are removed when a query is rendered.
+# Primary keys are dropped as well: Redshift does not enforce them, and
+# the ETL removes duplicates after inserting instead.
+
+postgres_rewrites = [
+    (r"\s+(COMPOUND\s+)?SORTKEY\s*\([^)]*\)", ""),
+    (r"\s+DISTKEY\s*\([^)]*\)", ""),
+    (r"\s+DISTSTYLE\s+\w+", ""),
+    (r"\s+(DISTKEY|SORTKEY)\b", ""),
+    (r",\s*PRIMARY KEY\s*\([^)]*\)", ""),
+    (r"\s+PRIMARY KEY\b", ""),
+    (r"IDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\)",
+     "GENERATED BY DEFAULT AS IDENTITY"),
+]
+
+dialects = ('redshift', 'postgres')
+
+
+def to_postgres(sql):
+    """Rewrite a Redshift statement for Postgres."""
+    for pattern, replacement in postgres_rewrites:
+        sql = re.sub(pattern, replacement, sql)
+    return sql
+
+
+# QUERY REGISTRY
+
+param_types = {'INTEGER': int,
+               'BIGINT': int,
+               'VARCHAR': str,
+               'TIMESTAMP': datetime.datetime.fromisoformat}
+
+
+class Query:
+    """A named SQL template and its metadata.
+
+    The template may contain config placeholders such as {ARN}, listed in
+    'config_values', and positional parameters $1, $2, ... declared in
+    'params' as (name, SQL type) pairs in that order. 'table' is the
+    table the query writes to or checks, 'depends_on' lists the tables it
+    reads. 'prepare' is set for statements that run many times, like the
+    quarantine DML and the analytic queries; 'execute' prepares them once
+    per connection. DDL, COPY and multi-statement queries cannot be
+    prepared, and statements that run once per load gain nothing.
+    The name is set from the variable name when the registry is built.
+    """
+
+    def __init__(self, sql, table=None, depends_on=(), params=(),
+                 prepare=False):
+        if params and not prepare:
+            raise ValueError("Parameterized queries must be prepared.")
+        self.name = None
+        self.sql = sql
+        self.table = table
+        self.depends_on = tuple(depends_on)
+        self.params = tuple(params)
+        self.prepare = prepare
+        self.config_keys = tuple(sorted(set(
+            re.findall(r"\{([A-Z_]+)\}", sql))))
+
+    @property
+    def param_names(self):
+        return [name for name, sql_type in self.params]
+
+    def render(self, config=None, dialect='redshift'):
+        """Return the SQL text with the config values filled in."""
+        if dialect not in dialects:
+            raise ValueError(f"Unknown dialect '{dialect}'.")
+        sql = self.sql
+        if self.config_keys:
+            config = config or load_config()
+            values = {}
+            for key in self.config_keys:
+                section, option, fallback = config_values[key]
+                values[key] = config.get(section, option, fallback=fallback)
+            sql = sql.format(**values)
+        if dialect == 'postgres':
+            sql = to_postgres(sql)
+        return sql
+
+    def bind(self, **values):
+        """Return the parameter values in the order of the template.
+
+        Strings, e.g. from a query string, are converted to the declared
+        type of their parameter.
+        """
+        unknown = set(values) - set(self.param_names)
+        if unknown:
+            raise TypeError(f"Query '{self.name}' has no parameters "
+                            f"{sorted(unknown)}.")
+        args = []
+        for name, sql_type in self.params:
+            if name not in values:
+                raise TypeError(f"Query '{self.name}' needs parameter "
+                                f"'{name}'.")
+            value = values[name]
+            if isinstance(value, str):
+                value = param_types[sql_type](value)
+            args.append(value)
+        return args
+
+    def __repr__(self):
+        return f"<Query {self.name}>"
+
+
+# Names of the statements already prepared on each psycopg2 connection.
+_prepared = weakref.WeakKeyDictionary()
+
+
+def execute(cur, query, config=None, dialect='redshift', **params):
+    """Execute a registered query on a psycopg2 cursor.
+
+    'query' is a Query or the name of one. Prepared queries are sent to
+    the server with PREPARE on first use per connection and run with
+    EXECUTE afterwards, so they are parsed and planned only once.
+    'dialect' is the database behind the cursor, see 'to_postgres'.
+    """
+    if isinstance(query, str):
+        query = queries[query]
+    args = query.bind(**params)
+    if not query.prepare:
+        cur.execute(query.render(config, dialect))
+        return
+
+    prepared = _prepared.setdefault(cur.connection, set())
+    if query.name not in prepared:
+        types = ""
+        if query.params:
+            types = " ({})".format(", ".join(sql_type for name, sql_type
+                                             in query.params))
+        cur.execute(f"PREPARE {query.name}{types} AS "
+                    f"{query.render(config, dialect)}")
+        prepared.add(query.name)
+    if args:
+        cur.execute("EXECUTE {} ({})".format(
+            query.name, ", ".join(["%s"] * len(args))), args)
+    else:
+        cur.execute(f"EXECUTE {query.name}")
 
-LOG_DATA = config.get('S3', 'LOG_DATA')
-LOG_JSONPATH = config.get('S3', 'LOG_JSONPATH')
-SONG_DATA = config.get('S3', 'SONG_DATA')
 
 # DROP TABLES
 
-scan_existing_tables = """
+scan_existing_tables = Query("""
 SELECT DISTINCT tablename
   FROM PG_TABLE_DEF
  WHERE schemaname = 'public';
-"""
+""", depends_on=('pg_table_def',))
 
-staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
-staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
-songplay_table_drop = "DROP TABLE IF EXISTS songplays"
-user_table_drop = "DROP TABLE IF EXISTS users CASCADE"
-song_table_drop = "DROP TABLE IF EXISTS songs CASCADE"
-artist_table_drop = "DROP TABLE IF EXISTS artists CASCADE"
-time_table_drop = "DROP TABLE IF EXISTS time CASCADE"
+staging_events_table_drop = Query("DROP TABLE IF EXISTS staging_events",
+                                  table='staging_events')
+staging_songs_table_drop = Query("DROP TABLE IF EXISTS staging_songs",
+                                 table='staging_songs')
+songplay_table_drop = Query("DROP TABLE IF EXISTS songplays",
+                            table='songplays')
+user_table_drop = Query("DROP TABLE IF EXISTS users CASCADE",
+                        table='users')
+song_table_drop = Query("DROP TABLE IF EXISTS songs CASCADE",
+                        table='songs')
+artist_table_drop = Query("DROP TABLE IF EXISTS artists CASCADE",
+                          table='artists')
+time_table_drop = Query("DROP TABLE IF EXISTS time CASCADE",
+                        table='time')
+quarantine_table_drop = Query("DROP TABLE IF EXISTS load_errors_quarantine",
+                              table='load_errors_quarantine')
 
 # TRUNCATE TABLES
 
-staging_events_table_truncate = "TRUNCATE TABLE staging_events ;"
-staging_songs_table_truncate = "TRUNCATE TABLE staging_songs ;"
-songplays_table_truncate = "TRUNCATE TABLE songplays ;"
-songs_table_truncate = "TRUNCATE TABLE songs ;"
-artists_table_truncate = "TRUNCATE TABLE artists ;"
-users_table_truncate = "TRUNCATE TABLE users ;"
-time_table_truncate = "TRUNCATE TABLE time ;"
+staging_events_table_truncate = Query("TRUNCATE TABLE staging_events ;",
+                                      table='staging_events')
+staging_songs_table_truncate = Query("TRUNCATE TABLE staging_songs ;",
+                                     table='staging_songs')
+songplays_table_truncate = Query("TRUNCATE TABLE songplays ;",
+                                 table='songplays')
+songs_table_truncate = Query("TRUNCATE TABLE songs ;",
+                             table='songs')
+artists_table_truncate = Query("TRUNCATE TABLE artists ;",
+                               table='artists')
+users_table_truncate = Query("TRUNCATE TABLE users ;",
+                             table='users')
+time_table_truncate = Query("TRUNCATE TABLE time ;",
+                            table='time')
 
 # CREATE TABLES
 
-staging_events_table_create= ("""
+staging_events_table_create = Query("""
 CREATE TABLE IF NOT EXISTS staging_events (
   artist VARCHAR,
   auth VARCHAR,
@@ -59,9 +232,9 @@ CREATE TABLE IF NOT EXISTS staging_events (
   userAgent VARCHAR,
   userId INTEGER
 );
-""")
+""", table='staging_events')
 
-staging_songs_table_create = ("""
+staging_songs_table_create = Query("""
 CREATE TABLE IF NOT EXISTS staging_songs (
   num_songs INT,
   artist_id VARCHAR,
@@ -74,44 +247,51 @@ CREATE TABLE IF NOT EXISTS staging_songs (
   duration DECIMAL,
   year INTEGER
 );
-""")
+""", table='staging_songs')
 
-songplay_table_create = ("""
+songplay_table_create = Query("""
 CREATE TABLE IF NOT EXISTS songplays (
-  songplay_id INTEGER IDENTITY (1,1) PRIMARY KEY SORTKEY,
+  songplay_id INTEGER IDENTITY (1,1) PRIMARY KEY,
+  event_hash VARCHAR(32) NOT NULL DISTKEY SORTKEY,
   start_time TIMESTAMP NOT NULL,
   user_id INTEGER NOT NULL,
   level VARCHAR,
-  song_id VARCHAR NOT NULL DISTKEY,
+  song_id VARCHAR NOT NULL,
   artist_id VARCHAR NOT NULL,
   session_id VARCHAR NOT NULL,
   location VARCHAR,
   user_agent VARCHAR
 );
-""")
+""", table='songplays')
 
-user_table_create = ("""
+user_table_create = Query("""
 CREATE TABLE IF NOT EXISTS users (
-  user_id INTEGER PRIMARY KEY SORTKEY,
+  user_id INTEGER NOT NULL,
   first_name VARCHAR,
   last_name VARCHAR,
   gender VARCHAR,
-  level VARCHAR
+  level VARCHAR,
+  valid_from TIMESTAMP NOT NULL,
+  valid_to TIMESTAMP,
+  is_current BOOLEAN NOT NULL,
+  PRIMARY KEY (user_id, valid_from)
   )
-DISTSTYLE ALL;
-""")
+DISTSTYLE ALL
+COMPOUND SORTKEY(user_id, valid_from);
+""", table='users')
 
-song_table_create = ("""
+song_table_create = Query("""
 CREATE TABLE IF NOT EXISTS songs (
-  song_id VARCHAR PRIMARY KEY DISTKEY SORTKEY,
+  song_id VARCHAR PRIMARY KEY SORTKEY,
   title VARCHAR,
   artist_id VARCHAR,
   year INTEGER,
   duration NUMERIC
-);
-""")
+)
+DISTSTYLE ALL;
+""", table='songs')
 
-artist_table_create = ("""
+artist_table_create = Query("""
 CREATE TABLE IF NOT EXISTS artists (
   artist_id VARCHAR PRIMARY KEY SORTKEY,
   name VARCHAR,
@@ -120,9 +300,9 @@ CREATE TABLE IF NOT EXISTS artists (
   longitude DECIMAL
 )
 DISTSTYLE ALL;
-""")
+""", table='artists')
 
-time_table_create = ("""
+time_table_create = Query("""
 CREATE TABLE IF NOT EXISTS time (
   start_time TIMESTAMP PRIMARY KEY SORTKEY,
   hour INTEGER,
@@ -133,28 +313,154 @@ CREATE TABLE IF NOT EXISTS time (
   weekday INTEGER
 )
 DISTSTYLE ALL;
-""")
+""", table='time')
+
+# Records rejected while loading the staging tables, either by COPY
+# (from STL_LOAD_ERRORS) or by the parser of the local loader.
+quarantine_table_create = Query("""
+CREATE TABLE IF NOT EXISTS load_errors_quarantine (
+  table_name VARCHAR NOT NULL,
+  filename VARCHAR(256),
+  line_number BIGINT,
+  colname VARCHAR(127),
+  err_reason VARCHAR(256),
+  raw_line VARCHAR(65535),
+  quarantined_at TIMESTAMP NOT NULL,
+  reprocessed BOOLEAN NOT NULL
+);
+""", table='load_errors_quarantine')
 
 # STAGING TABLES
 
-staging_events_copy = ("""
-COPY staging_events FROM {}
-    CREDENTIALS 'aws_iam_role={}'
-    JSON {}
+staging_events_copy = Query("""
+COPY staging_events (artist, auth, firstName, gender, iteminSession,
+                     lastName, length, level, location, method, page,
+                     registration, sessionId, song, status, ts,
+                     userAgent, userId)
+    FROM {LOG_DATA}
+    CREDENTIALS 'aws_iam_role={ARN}'
+    JSON {LOG_JSONPATH}
     REGION 'us-west-2'
-""").format(LOG_DATA, ARN, LOG_JSONPATH)
+    MAXERROR {MAXERROR}
+""", table='staging_events')
 
-staging_songs_copy = ("""
-COPY staging_songs FROM {}
-    CREDENTIALS 'aws_iam_role={}'
+staging_songs_copy = Query("""
+COPY staging_songs FROM {SONG_DATA}
+    CREDENTIALS 'aws_iam_role={ARN}'
     JSON 'auto'
     REGION 'us-west-2'
-""").format(SONG_DATA, ARN)
+    MAXERROR {MAXERROR}
+""", table='staging_songs')
+
+# LOAD ERRORS
+
+copy_load_errors = Query("""
+SELECT TRIM(filename),
+       line_number,
+       TRIM(colname),
+       TRIM(err_reason),
+       TRIM(raw_line)
+  FROM STL_LOAD_ERRORS
+ WHERE query = pg_last_copy_id()
+ ORDER BY filename,
+          line_number;
+""", depends_on=('stl_load_errors',))
+
+quarantine_insert = Query("""
+INSERT INTO load_errors_quarantine (table_name,
+                                    filename,
+                                    line_number,
+                                    colname,
+                                    err_reason,
+                                    raw_line,
+                                    quarantined_at,
+                                    reprocessed)
+VALUES ($1, $2, $3, $4, $5, $6, $7, FALSE);
+""",
+    table='load_errors_quarantine',
+    params=[('table_name', 'VARCHAR'),
+            ('filename', 'VARCHAR'),
+            ('line_number', 'BIGINT'),
+            ('colname', 'VARCHAR'),
+            ('err_reason', 'VARCHAR'),
+            ('raw_line', 'VARCHAR'),
+            ('quarantined_at', 'TIMESTAMP')],
+    prepare=True)
+
+quarantine_pending = Query("""
+SELECT DISTINCT filename,
+       line_number
+  FROM load_errors_quarantine
+ WHERE table_name = $1
+   AND NOT reprocessed
+ ORDER BY filename,
+          line_number;
+""", table='load_errors_quarantine', params=[('table_name', 'VARCHAR')],
+    prepare=True)
+
+quarantine_mark_reprocessed = Query("""
+UPDATE load_errors_quarantine
+   SET reprocessed = TRUE
+ WHERE table_name = $1
+   AND filename = $2
+   AND line_number = $3;
+""",
+    table='load_errors_quarantine',
+    params=[('table_name', 'VARCHAR'),
+            ('filename', 'VARCHAR'),
+            ('line_number', 'BIGINT')],
+    prepare=True)
+
+quarantine_update_reason = Query("""
+UPDATE load_errors_quarantine
+   SET err_reason = $1
+ WHERE table_name = $2
+   AND filename = $3
+   AND line_number = $4;
+""",
+    table='load_errors_quarantine',
+    params=[('err_reason', 'VARCHAR'),
+            ('table_name', 'VARCHAR'),
+            ('filename', 'VARCHAR'),
+            ('line_number', 'BIGINT')],
+    prepare=True)
+
+# Deterministic content hash per event. Reloads and overlapping backfills
+# produce the same hash, so songplays can skip events it already holds.
+# The hashed events are written in one pass into a temporary table that is
+# distributed and sorted on event_hash like songplays, so the anti-join in
+# songplay_table_insert runs as a merge join. staging_events itself stays
+# EVEN, since the hash does not exist yet during COPY.
+staging_events_hash = Query("""
+DROP TABLE IF EXISTS staged_events;
+
+CREATE TEMP TABLE staged_events
+DISTKEY(event_hash)
+SORTKEY(event_hash)
+AS
+SELECT MD5(COALESCE(CAST(userId AS VARCHAR), '') || '|' ||
+           COALESCE(CAST(sessionId AS VARCHAR), '') || '|' ||
+           COALESCE(CAST(itemInSession AS VARCHAR), '') || '|' ||
+           COALESCE(CAST(ts AS VARCHAR), '')) AS event_hash,
+       *
+  FROM staging_events
+ WHERE page = 'NextSong';
+""", table='staged_events', depends_on=('staging_events',))
+
+# Inserts leave an unsorted region in songplays. Sorting it after every
+# load keeps the anti-join on event_hash a merge join.
+songplays_sort = Query("VACUUM SORT ONLY songplays;",
+                       table='songplays')
 
 # FINAL TABLES
 
-songplay_table_insert = ("""
-INSERT INTO songplays (start_time,
+# Songs and artists are looked up in the dimensions rather than in
+# staging_songs, so events reprocessed without their song data still find
+# them. Runs after the dimension inserts. Several matching songs or artist
+# rows are reduced to one songplay per event_hash.
+songplay_table_insert = Query("""
+INSERT INTO songplays (event_hash,
+                       start_time,
                        user_id,
                        level,
                        song_id,
@@ -162,78 +468,207 @@ INSERT INTO songplays (start_time,
                        session_id,
                        location,
                        user_agent)
+WITH new_events AS (
+    SELECT s_events.*
+      FROM staged_events AS s_events
+           LEFT JOIN songplays
+             ON songplays.event_hash = s_events.event_hash
+     WHERE songplays.event_hash IS NULL
+    ),
+matched_events AS (
+    SELECT ROW_NUMBER() OVER (PARTITION BY s_events.event_hash
+                              ORDER BY songs.song_id) AS event_row,
+           s_events.event_hash,
+           s_events.ts,
+           s_events.userId,
+           s_events.level,
+           songs.song_id,
+           songs.artist_id,
+           s_events.sessionId,
+           s_events.location,
+           s_events.userAgent
+      FROM new_events AS s_events
+           JOIN songs
+             ON songs.title = s_events.song
+            AND songs.duration = s_events.length
+           JOIN artists
+             ON artists.artist_id = songs.artist_id
+            AND artists.name = s_events.artist
+    )
 SELECT
-    timestamp 'epoch' + CAST(s_events.ts/1000 AS BIGINT) * interval '1 second' as start_time,
-    s_events.userId,
-    s_events.level,
-    s_songs.song_id,
-    s_songs.artist_id,
-    s_events.sessionId,
-    s_events.location,
-    s_events.userAgent
-FROM staging_events AS s_events
-     JOIN staging_songs AS s_songs
-       ON s_songs.title = s_events.song
-      AND s_songs.artist_name = s_events.artist
-      AND s_songs.duration = s_events.length
-WHERE page = 'NextSong'; """)
-
-user_table_insert = ("""
+    event_hash,
+    timestamp 'epoch' + ts / 1000.0 * interval '1 second' AS start_time,
+    userId,
+    level,
+    song_id,
+    artist_id,
+    sessionId,
+    location,
+    userAgent
+FROM matched_events
+WHERE event_row = 1; """,
+    table='songplays',
+    depends_on=('staged_events', 'songs', 'artists', 'songplays'))
+
+# Type-2 slowly changing dimension. One window pass over the current
+# users and all newer staged events keeps every event whose attributes
+# differ from the previous one as a new version. Afterwards each
+# superseded current version is closed at the start of the version that
+# directly follows it, so a reload only touches users whose attributes
+# changed. Versions start at the millisecond 'ts' of
+# their event; of several events of a user in the same millisecond the
+# one with the highest sessionId and itemInSession wins. Events older
+# than the current version of their user cannot be placed into the
+# closed history and are discarded.
+user_table_insert = Query("""
 INSERT INTO users (user_id,
                    first_name,
                    last_name,
                    gender,
-                   level)
-    SELECT
-        DISTINCT(userid) AS user_id,
-        firstname,
-        lastname,
-        gender,
-        level
-    FROM staging_events AS s1
-    WHERE userid IS NOT NULL
-      AND ts = (
-                SELECT MAX(ts)
-                FROM staging_events AS s2
-                WHERE s2.userId = s1.userId)
-    ;
-""")
+                   level,
+                   valid_from,
+                   valid_to,
+                   is_current)
+WITH current_users AS (
+    SELECT user_id,
+           first_name,
+           last_name,
+           gender,
+           level,
+           valid_from
+      FROM users
+     WHERE is_current
+    ),
+staged_users AS (
+    SELECT userId AS user_id,
+           firstName AS first_name,
+           lastName AS last_name,
+           gender,
+           level,
+           timestamp 'epoch' + ts / 1000.0 * interval '1 second'
+               AS valid_from,
+           ROW_NUMBER() OVER (PARTITION BY userId, ts
+                              ORDER BY sessionId DESC,
+                                       itemInSession DESC) AS event_row
+      FROM staging_events
+     WHERE userId IS NOT NULL
+       AND ts IS NOT NULL
+    ),
+events AS (
+    SELECT staged_users.user_id,
+           staged_users.first_name,
+           staged_users.last_name,
+           staged_users.gender,
+           staged_users.level,
+           staged_users.valid_from,
+           FALSE AS is_stored
+      FROM staged_users
+           LEFT JOIN current_users
+             ON current_users.user_id = staged_users.user_id
+     WHERE staged_users.event_row = 1
+       AND (current_users.user_id IS NULL
+            OR staged_users.valid_from > current_users.valid_from)
+    UNION ALL
+    SELECT user_id,
+           first_name,
+           last_name,
+           gender,
+           level,
+           valid_from,
+           TRUE AS is_stored
+      FROM current_users
+    ),
+changes AS (
+    SELECT *,
+           LAG(attributes) OVER (PARTITION BY user_id
+                                 ORDER BY valid_from) AS previous_attributes
+      FROM (SELECT *,
+                   COALESCE(first_name, '') || '|' ||
+                   COALESCE(last_name, '') || '|' ||
+                   COALESCE(gender, '') || '|' ||
+                   COALESCE(level, '') AS attributes
+              FROM events) AS events_with_attributes
+    ),
+new_versions AS (
+    SELECT user_id,
+           first_name,
+           last_name,
+           gender,
+           level,
+           valid_from,
+           LEAD(valid_from) OVER (PARTITION BY user_id
+                                  ORDER BY valid_from) AS valid_to
+      FROM changes
+     WHERE NOT is_stored
+       AND (previous_attributes IS NULL
+            OR attributes <> previous_attributes)
+    )
+SELECT user_id,
+       first_name,
+       last_name,
+       gender,
+       level,
+       valid_from,
+       valid_to,
+       valid_to IS NULL AS is_current
+  FROM new_versions;
 
-song_table_insert = ("""
+UPDATE users
+   SET valid_to = superseded.next_valid_from,
+       is_current = FALSE
+  FROM (SELECT user_id,
+               valid_from,
+               LEAD(valid_from) OVER (PARTITION BY user_id
+                                      ORDER BY valid_from) AS next_valid_from
+          FROM users) AS superseded
+ WHERE users.user_id = superseded.user_id
+   AND users.valid_from = superseded.valid_from
+   AND users.is_current
+   AND superseded.next_valid_from IS NOT NULL;
+""", table='users', depends_on=('staging_events', 'users'))
+
+song_table_insert = Query("""
 INSERT INTO songs (song_id,
                    title,
                    artist_id,
                    year,
                    duration)
     SELECT
-        DISTINCT(song_id) AS song_id,
-        title,
-        artist_id,
-        year,
-        duration
-    FROM staging_songs
-    WHERE song_id IS NOT NULL
+        DISTINCT(s_songs.song_id) AS song_id,
+        s_songs.title,
+        s_songs.artist_id,
+        s_songs.year,
+        s_songs.duration
+    FROM staging_songs AS s_songs
+         LEFT JOIN songs
+           ON songs.song_id = s_songs.song_id
+    WHERE s_songs.song_id IS NOT NULL
+      AND songs.song_id IS NULL
     ;
-""")
+""", table='songs', depends_on=('staging_songs', 'songs'))
 
-artist_table_insert = ("""
+artist_table_insert = Query("""
 INSERT INTO artists (artist_id,
                      name,
                      location,
                      latitude,
                      longitude)
     SELECT
-        DISTINCT(artist_id) AS artist_id,
-        artist_name,
-        artist_location,
-        artist_latitude,
-        artist_longitude
-    FROM staging_songs
-    WHERE artist_id IS NOT NULL
+        DISTINCT(s_songs.artist_id) AS artist_id,
+        s_songs.artist_name,
+        s_songs.artist_location,
+        s_songs.artist_latitude,
+        s_songs.artist_longitude
+    FROM staging_songs AS s_songs
+         LEFT JOIN artists
+           ON artists.artist_id = s_songs.artist_id
+          AND artists.name = s_songs.artist_name
+    WHERE s_songs.artist_id IS NOT NULL
+      AND artists.artist_id IS NULL
         ;
-""")
+""", table='artists', depends_on=('staging_songs', 'artists'))
 
-time_table_insert = ("""
+time_table_insert = Query("""
 INSERT INTO time (start_time,
                   hour,
                   day,
@@ -242,42 +677,48 @@ INSERT INTO time (start_time,
                   year,
                   weekday)
 WITH timetable AS (
-    SELECT timestamp 'epoch' + CAST(ts/1000 AS BIGINT) * interval '1 second' as start_time
+    SELECT DISTINCT
+           timestamp 'epoch' + ts / 1000.0 * interval '1 second' AS start_time
       FROM staging_events
+     WHERE ts IS NOT NULL
     )
 SELECT
-    DISTINCT(start_time) AS start_time,
-    DATEPART('hour', start_time) AS hour,
-    DATEPART('day', start_time) AS day,
-    DATEPART('week', start_time) AS week,
-    DATEPART('month', start_time) AS month,
-    DATEPART('year', start_time) AS year,
-    DATEPART('dayofweek', start_time) AS weekday
-FROM timetable;
-""")
+    timetable.start_time,
+    EXTRACT(hour FROM timetable.start_time) AS hour,
+    EXTRACT(day FROM timetable.start_time) AS day,
+    EXTRACT(week FROM timetable.start_time) AS week,
+    EXTRACT(month FROM timetable.start_time) AS month,
+    EXTRACT(year FROM timetable.start_time) AS year,
+    EXTRACT(dow FROM timetable.start_time) AS weekday
+FROM timetable
+     LEFT JOIN time
+       ON time.start_time = timetable.start_time
+WHERE time.start_time IS NULL;
+""", table='time', depends_on=('staging_events', 'time'))
 
 # CLEAN DATA
 
-set_year_null = ("""
+set_year_null = Query("""
 UPDATE songs
    SET year = NULL
  WHERE year = 0
-""")
+""", table='songs')
 
-detect_year_zero = ("""
+detect_year_zero = Query("""
 SELECT song_id,
        year
   FROM songs
  WHERE year = 0
  LIMIT 5;
-""")
+""", table='songs')
 
 # CHECK FOR DUPLICATES
 
-users_check_duplicates = ("""
+users_check_duplicates = Query("""
 WITH duplicates AS (
-SELECT COUNT(*) OVER(PARTITION BY user_id) AS num_duplicates,
+SELECT COUNT(*) OVER(PARTITION BY user_id, valid_from) AS num_duplicates,
        user_id,
+       valid_from,
        first_name,
        last_name,
        gender,
@@ -285,16 +726,15 @@ SELECT COUNT(*) OVER(PARTITION BY user_id) AS num_duplicates,
   FROM users
  ORDER BY num_duplicates DESC,
           user_id,
-          first_name,
-          last_name
+          valid_from
  LIMIT 5)
 SELECT num_duplicates,
        user_id
   FROM duplicates
  WHERE num_duplicates > 1;
-""")
+""", table='users')
 
-songs_check_duplicates = ("""
+songs_check_duplicates = Query("""
 WITH duplicates AS (
     SELECT COUNT(*) OVER(PARTITION BY song_id) AS num_duplicates,
            song_id,
@@ -311,9 +751,9 @@ SELECT num_duplicates,
        song_id
   FROM duplicates
  WHERE num_duplicates > 1;
-""")
+""", table='songs')
 
-artists_check_duplicates = ("""
+artists_check_duplicates = Query("""
 WITH duplicates AS (
     SELECT COUNT(*) OVER (PARTITION BY artist_id, name) AS num_duplicates,
            artist_id,
@@ -331,29 +771,29 @@ WITH duplicates AS (
 SELECT num_duplicates
   FROM duplicates
  WHERE num_duplicates > 1;
-""")
+""", table='artists')
 
-time_check_duplicates = ("""
+time_check_duplicates = Query("""
 SELECT COUNT(*) AS num_duplicates,
        start_time
 FROM time
 GROUP BY start_time
-HAVING num_duplicates > 1
+HAVING COUNT(*) > 1
 ORDER BY COUNT(*) DESC
 LIMIT 5;
-""")
+""", table='time')
 
-songplays_check_duplicates = ("""
+songplays_check_duplicates = Query("""
 SELECT COUNT(songplay_id) AS num_duplicates,
-       start_time
+       event_hash
   FROM songplays
- GROUP BY start_time
-HAVING num_duplicates > 1
+ GROUP BY event_hash
+HAVING COUNT(songplay_id) > 1
  ORDER BY num_duplicates DESC
  LIMIT 5;
-""")
+""", table='songplays')
 
-artists_remove_duplicates = ("""
+artists_remove_duplicates = Query("""
 WITH ordered_duplicates AS (
         SELECT COUNT(*) OVER (PARTITION BY artist_id, name)
                   AS total_duplicates,
@@ -407,12 +847,12 @@ INSERT INTO artists (
   FROM duplicates_table;
 
 DROP TABLE duplicates_table;
-""")
+""", table='artists')
 
 # ANALYTIC QUERIES
 
 # Most played artist
-songplays_per_artist = ("""
+songplays_per_artist = Query("""
 SELECT
     artists.name,
     COUNT(songplays.start_time)
@@ -422,7 +862,119 @@ FROM songplays
 GROUP BY artists.name
 ORDER BY COUNT(songplays.start_time) DESC
 LIMIT 5;
-""")
+""", depends_on=('songplays', 'artists'), prepare=True)
+
+# Plays per subscription level, joined on the version of the user that
+# was valid when the song was played.
+songplays_per_user_level = Query("""
+SELECT
+    users.level,
+    COUNT(songplays.start_time) AS plays,
+    COUNT(DISTINCT songplays.user_id) AS listeners
+FROM songplays
+    JOIN users
+      ON songplays.user_id = users.user_id
+     AND songplays.start_time >= users.valid_from
+     AND (users.valid_to IS NULL
+          OR songplays.start_time < users.valid_to)
+GROUP BY users.level
+ORDER BY users.level;
+""", depends_on=('songplays', 'users'), prepare=True)
+
+# Parameterized dashboard queries, also replayed by benchmark.py.
+top_artists_in_year = Query("""
+SELECT artists.name,
+       COUNT(*) AS plays
+  FROM songplays
+  JOIN artists
+    ON songplays.artist_id = artists.artist_id
+  JOIN time
+    ON songplays.start_time = time.start_time
+ WHERE time.year = $1
+ GROUP BY artists.name
+ ORDER BY plays DESC
+ LIMIT 10;
+""",
+    depends_on=('songplays', 'artists', 'time'),
+    params=[('year', 'INTEGER')],
+    prepare=True)
+
+plays_per_hour_on_weekday = Query("""
+SELECT time.hour,
+       COUNT(*) AS plays
+  FROM songplays
+  JOIN time
+    ON songplays.start_time = time.start_time
+ WHERE time.weekday = $1
+ GROUP BY time.hour
+ ORDER BY time.hour;
+""",
+    depends_on=('songplays', 'time'),
+    params=[('weekday', 'INTEGER')],
+    prepare=True)
+
+user_listening_history = Query("""
+SELECT songplays.start_time,
+       songs.title,
+       artists.name
+  FROM songplays
+  JOIN songs
+    ON songplays.song_id = songs.song_id
+  LEFT JOIN artists
+    ON songplays.artist_id = artists.artist_id
+ WHERE songplays.user_id = $1
+ ORDER BY songplays.start_time DESC
+ LIMIT 50;
+""",
+    depends_on=('songplays', 'songs', 'artists'),
+    params=[('user_id', 'INTEGER')],
+    prepare=True)
+
+level_share_in_month = Query("""
+SELECT songplays.level,
+       COUNT(*) AS plays,
+       COUNT(DISTINCT songplays.user_id) AS listeners
+  FROM songplays
+  JOIN time
+    ON songplays.start_time = time.start_time
+ WHERE time.month = $1
+ GROUP BY songplays.level;
+""",
+    depends_on=('songplays', 'time'),
+    params=[('month', 'INTEGER')],
+    prepare=True)
+
+top_songs_for_gender = Query("""
+SELECT songs.title,
+       COUNT(*) AS plays
+  FROM songplays
+  JOIN users
+    ON songplays.user_id = users.user_id
+  JOIN songs
+    ON songplays.song_id = songs.song_id
+ WHERE users.gender = $1
+   AND users.is_current
+ GROUP BY songs.title
+ ORDER BY plays DESC
+ LIMIT 10;
+""",
+    depends_on=('songplays', 'users', 'songs'),
+    params=[('gender', 'VARCHAR')],
+    prepare=True)
+
+# QUERY REGISTRY
+
+def _build_registry(namespace):
+    """Name every Query after its variable and return them by name."""
+    registry = {}
+    for name, query in namespace.items():
+        if isinstance(query, Query):
+            query.name = name
+            registry[name] = query
+    return registry
+
+
+queries = _build_registry(globals())
 
 # QUERY LISTS
 
@@ -432,14 +984,16 @@ create_table_queries = [staging_events_table_create,
                         user_table_create,
                         song_table_create,
                         artist_table_create,
-                        time_table_create]
+                        time_table_create,
+                        quarantine_table_create]
 drop_table_queries = [staging_events_table_drop,
                       staging_songs_table_drop,
                       songplay_table_drop,
                       user_table_drop,
                       song_table_drop,
                       artist_table_drop,
-                      time_table_drop]
+                      time_table_drop,
+                      quarantine_table_drop]
 truncate_table_queries = [staging_events_table_truncate,
                           staging_songs_table_truncate,
                           songplays_table_truncate,
@@ -451,13 +1005,20 @@ drop_staging_tables_queries = [staging_events_table_drop,
                                staging_songs_table_drop]
 copy_table_queries = [staging_events_copy,
                       staging_songs_copy]
-insert_table_queries = [songplay_table_insert,
-                        user_table_insert,
-                        song_table_insert,
+insert_table_queries = [song_table_insert,
                         artist_table_insert,
-                        time_table_insert]
-check_duplicates_queries= [users_check_duplicates,
-                           songs_check_duplicates,
-                           artists_check_duplicates,
-                           time_check_duplicates,
-                           songplays_check_duplicates]
+                        user_table_insert,
+                        time_table_insert,
+                        songplay_table_insert]
+check_duplicates_queries = [users_check_duplicates,
+                            songs_check_duplicates,
+                            artists_check_duplicates,
+                            time_check_duplicates,
+                            songplays_check_duplicates]
+analytic_queries = [songplays_per_artist,
+                    songplays_per_user_level,
+                    top_artists_in_year,
+                    plays_per_hour_on_weekday,
+                    user_listening_history,
+                    level_share_in_month,
+                    top_songs_for_gender]
@@ -0,0 +1,168 @@
+import json
+import pytest
+
+pytest.importorskip('psycopg2')
+import local_loader
+from local_loader import RecordError,\
+                         event_columns,\
+                         staging_limits,\
+                         parse_record,\
+                         parse_lines,\
+                         load_staging_table,\
+                         reprocess_quarantine
+
+event_limits = staging_limits['staging_events']
+
+
+def event(**fields):
+    record = {'userId': '7', 'gender': 'F', 'page': 'NextSong',
+              'ts': 1541105830796}
+    record.update(fields)
+    return json.dumps(record)
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.commits = 0
+        self.rollbacks = 0
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeCache:
+    """Serve file bodies from a dict and count the reads."""
+
+    def __init__(self, files):
+        self.files = files
+        self.gets = []
+
+    def iter_objects(self, bucket, prefix):
+        for key, body in self.files.items():
+            yield key, body
+
+    def get(self, bucket, key):
+        self.gets.append(key)
+        return self.files[key]
+
+    def save(self):
+        pass
+
+
+def test_limits_are_read_from_the_staging_ddl():
+    assert event_limits['gender'] == ('VARCHAR', 5)
+    assert event_limits['artist'] == ('VARCHAR', 256)
+    assert event_limits['ts'] == ('INTEGER', 2**63)
+    assert staging_limits['staging_songs']['num_songs'] == ('INTEGER', 2**31)
+
+
+def test_varchar_length_is_counted_in_bytes():
+    row = parse_record(event(gender='Fema'), event_columns, event_limits)
+    assert 'Fema' in row
+    # Five characters, six bytes.
+    with pytest.raises(RecordError) as error:
+        parse_record(event(gender='Femäl'), event_columns, event_limits)
+    assert error.value.colname == 'gender'
+
+
+def test_integer_out_of_range():
+    parse_record(event(userId=2**31 - 1), event_columns, event_limits)
+    with pytest.raises(RecordError) as error:
+        parse_record(event(userId=2**31), event_columns, event_limits)
+    assert error.value.colname == 'userId'
+
+
+def test_invalid_json_and_types():
+    with pytest.raises(RecordError, match="Invalid JSON"):
+        parse_record('{"userId": ', event_columns, event_limits)
+    with pytest.raises(RecordError, match="not a JSON object"):
+        parse_record('[1, 2]', event_columns, event_limits)
+    with pytest.raises(RecordError) as error:
+        parse_record(event(ts='yesterday'), event_columns, event_limits)
+    assert error.value.colname == 'ts'
+
+
+def test_empty_values_become_null():
+    row = parse_record(event(userId=''), event_columns, event_limits)
+    assert row[-1] is None
+
+
+def test_rejected_lines_are_recorded_with_their_line_number():
+    body = "\n".join([event(), "", "not json", event(userId=2**40)])
+    errors = []
+    rows = parse_lines(body.encode('utf-8'), event_columns, event_limits,
+                       's3://bucket/log.json', errors)
+    assert len(rows) == 1
+    assert [(filename, line_number, colname)
+            for filename, line_number, colname, reason, line in errors] \
+        == [('s3://bucket/log.json', 3, ''),
+            ('s3://bucket/log.json', 4, 'userId')]
+    assert errors[0][4] == "not json"
+
+
+def test_load_is_rolled_back_beyond_the_error_budget(monkeypatch, tmp_path):
+    inserted = []
+    monkeypatch.setattr(local_loader, 'insert_rows',
+                        lambda cur, table, columns, rows:
+                        inserted.append(rows))
+    monkeypatch.setattr(local_loader, 'write_quarantine',
+                        lambda *args: pytest.fail("Nothing is quarantined."))
+    cache = FakeCache({'log_data/a.json': event().encode('utf-8'),
+                       'log_data/b.json': b"not json\n{\n"})
+    conn = FakeConnection()
+
+    with pytest.raises(ValueError, match="more than 1 rejected lines"):
+        load_staging_table(None, conn, cache, 's3://bucket/log_data',
+                           'staging_events', 1, tmp_path / 'quarantine.jsonl')
+    assert len(inserted) == 1
+    assert (conn.commits, conn.rollbacks) == (0, 1)
+
+
+def test_load_within_the_error_budget_quarantines(monkeypatch, tmp_path):
+    monkeypatch.setattr(local_loader, 'insert_rows', lambda *args: None)
+    quarantined = []
+    monkeypatch.setattr(local_loader, 'write_quarantine',
+                        lambda cur, conn, table, errors, path:
+                        quarantined.extend(errors))
+    cache = FakeCache({'log_data/a.json': b"not json\n" +
+                       event().encode('utf-8')})
+    conn = FakeConnection()
+
+    load_staging_table(None, conn, cache, 's3://bucket/log_data',
+                       'staging_events', 1, tmp_path / 'quarantine.jsonl')
+    assert [error[1] for error in quarantined] == [1]
+    assert (conn.commits, conn.rollbacks) == (1, 0)
+
+
+def test_reprocessing_reads_each_file_once(monkeypatch):
+    song = json.dumps({'song_id': 'S1', 'artist_id': 'A1', 'year': 2000})
+    cache = FakeCache({'song_data/a.json': f"{song}\n{song}\n{{\n".encode(),
+                       'song_data/b.json': f"{song}\n".encode()})
+    pending = [('s3://bucket/song_data/a.json', 1),
+               ('s3://bucket/song_data/a.json', 3),
+               ('s3://bucket/song_data/b.json', 1),
+               ('s3://bucket/song_data/a.json', 2),
+               ('s3://bucket/song_data/b.json', 5)]
+    inserted, reprocessed, failed = [], [], []
+    monkeypatch.setattr(local_loader, 'pending_records',
+                        lambda cur, table: pending)
+    monkeypatch.setattr(local_loader, 'insert_rows',
+                        lambda cur, table, columns, rows:
+                        inserted.extend(rows))
+    monkeypatch.setattr(local_loader, 'mark_reprocessed',
+                        lambda cur, table, filename, line_number:
+                        reprocessed.append((filename, line_number)))
+    monkeypatch.setattr(local_loader, 'update_reason',
+                        lambda cur, table, filename, line_number, reason:
+                        failed.append((filename, line_number)))
+
+    reprocess_quarantine(None, FakeConnection(), cache, 'staging_songs')
+    assert sorted(cache.gets) == ['song_data/a.json', 'song_data/b.json']
+    assert len(inserted) == 3
+    assert sorted(failed) == [('s3://bucket/song_data/a.json', 3),
+                              ('s3://bucket/song_data/b.json', 5)]
+    assert len(reprocessed) == 3
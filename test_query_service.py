@@ -0,0 +1,136 @@
+import asyncio
+import os
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('asyncpg')
+from aiohttp.test_utils import TestClient, TestServer
+from query_service import QueryService, create_app
+from sql_queries import analytic_queries,\
+                        create_table_queries,\
+                        execute
+
+
+class FakeConnection:
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def fetch(self, sql, *args, timeout=None):
+        pool = self.pool
+        pool.fetches.append((sql, args))
+        pool.running += 1
+        pool.max_running = max(pool.max_running, pool.running)
+        try:
+            await asyncio.sleep(pool.delay)
+        finally:
+            pool.running -= 1
+        return [{'args': list(args)}]
+
+
+class FakePool:
+    """Record every fetch and how many of them ran at the same time."""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.fetches = []
+        self.running = 0
+        self.max_running = 0
+
+    def acquire(self):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                return FakeConnection(pool)
+
+            async def __aexit__(self, *exc_info):
+                return False
+
+        return Acquire()
+
+
+def test_identical_concurrent_requests_share_one_fetch():
+    async def scenario():
+        pool = FakePool()
+        service = QueryService(pool, analytic_queries, slots=5, timeout=1)
+        results = await asyncio.gather(
+            *[service.run('top_artists_in_year', year='2018')
+              for _ in range(10)],
+            service.run('top_artists_in_year', year='2017'))
+        return pool, results
+
+    pool, results = asyncio.run(scenario())
+    assert len(pool.fetches) == 2
+    assert results[0] == [{'args': [2018]}]
+    assert results[-1] == [{'args': [2017]}]
+
+    # Once a query is done, the next request runs it again.
+    async def rerun():
+        service = QueryService(pool, analytic_queries, slots=5, timeout=1)
+        await service.run('top_artists_in_year', year='2018')
+        await service.run('top_artists_in_year', year='2018')
+
+    asyncio.run(rerun())
+    assert len(pool.fetches) == 4
+
+
+def test_no_more_than_slots_queries_run_at_once():
+    async def scenario():
+        pool = FakePool()
+        service = QueryService(pool, analytic_queries, slots=3, timeout=5)
+        await asyncio.gather(*[service.run('user_listening_history',
+                                           user_id=user_id)
+                               for user_id in range(12)])
+        return pool
+
+    pool = asyncio.run(scenario())
+    assert len(pool.fetches) == 12
+    assert pool.max_running == 3
+
+
+def test_http_errors():
+    async def scenario():
+        service = QueryService(FakePool(delay=1), analytic_queries,
+                               slots=5, timeout=0.05)
+        async with TestClient(TestServer(create_app(service))) as client:
+            responses = [
+                await client.get('/queries/top_artists_in_year?year=2018'),
+                await client.get('/queries/no_such_query'),
+                await client.get('/queries/top_artists_in_year'),
+                await client.get('/queries/top_artists_in_year?year=x')]
+            return [response.status for response in responses]
+
+    assert asyncio.run(scenario()) == [504, 404, 400, 400]
+
+
+def test_queries_run_against_postgres(postgres):
+    import asyncpg
+
+    conn, cur = postgres
+    for query in create_table_queries:
+        execute(cur, query, dialect='postgres')
+    cur.execute("""
+        INSERT INTO artists (artist_id, name) VALUES ('A1', 'Muse');
+        INSERT INTO time (start_time, year)
+             VALUES ('2018-11-01 20:57:10', 2018);
+        INSERT INTO songplays (event_hash, start_time, user_id, song_id,
+                               artist_id, session_id)
+             VALUES ('h1', '2018-11-01 20:57:10', 7, 'S1', 'A1', '1');
+    """)
+    conn.commit()
+    cur.execute("SHOW search_path;")
+    schema = cur.fetchone()[0]
+
+    async def scenario():
+        pool = await asyncpg.create_pool(
+            os.environ['SPARKIFY_TEST_DSN'], min_size=1, max_size=2,
+            server_settings={'search_path': schema})
+        try:
+            service = QueryService(pool, analytic_queries, slots=2,
+                                   timeout=10)
+            return await service.run('top_artists_in_year', year='2018')
+        finally:
+            await pool.close()
+
+    assert asyncio.run(scenario()) == [{'name': 'Muse', 'plays': 1}]
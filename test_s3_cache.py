@@ -0,0 +1,95 @@
+import boto3
+import pytest
+from moto import mock_aws
+from s3_cache import S3Cache
+
+BUCKET = 'udacity-dend'
+
+
+class CountingClient:
+    """Pass calls through to an S3 client and count the object GETs."""
+
+    def __init__(self, s3):
+        self.s3 = s3
+        self.downloads = 0
+        self.not_modified = 0
+
+    def get_object(self, **kwargs):
+        try:
+            response = self.s3.get_object(**kwargs)
+        except self.s3.exceptions.ClientError:
+            self.not_modified += 1
+            raise
+        self.downloads += 1
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        for number in range(4):
+            client.put_object(Bucket=BUCKET, Key=f"log_data/{number}.json",
+                              Body=b"x" * 100)
+        yield CountingClient(client)
+
+
+def test_unchanged_prefix_is_read_from_cache(s3, tmp_path):
+    cache = S3Cache(tmp_path, max_bytes=10**6, s3=s3)
+    first = dict(cache.iter_objects(BUCKET, 'log_data/'))
+    second = dict(cache.iter_objects(BUCKET, 'log_data/'))
+    assert first == second
+    assert s3.downloads == 4
+
+
+def test_changed_etag_is_downloaded_again(s3, tmp_path):
+    cache = S3Cache(tmp_path, max_bytes=10**6, s3=s3)
+    list(cache.iter_objects(BUCKET, 'log_data/'))
+    s3.put_object(Bucket=BUCKET, Key='log_data/2.json', Body=b"changed")
+
+    bodies = dict(cache.iter_objects(BUCKET, 'log_data/', refresh=True))
+    assert bodies['log_data/2.json'] == b"changed"
+    assert s3.downloads == 5
+
+
+def test_conditional_get_does_not_download_unchanged_body(s3, tmp_path):
+    cache = S3Cache(tmp_path, max_bytes=10**6, s3=s3)
+    assert cache.get(BUCKET, 'log_data/0.json') == b"x" * 100
+    assert cache.get(BUCKET, 'log_data/0.json') == b"x" * 100
+    assert (s3.downloads, s3.not_modified) == (1, 1)
+
+    s3.put_object(Bucket=BUCKET, Key='log_data/0.json', Body=b"changed")
+    assert cache.get(BUCKET, 'log_data/0.json') == b"changed"
+    assert (s3.downloads, s3.not_modified) == (2, 1)
+
+
+def test_least_recently_used_objects_are_evicted(s3, tmp_path):
+    cache = S3Cache(tmp_path, max_bytes=250, workers=1, s3=s3)
+    bodies = dict(cache.iter_objects(BUCKET, 'log_data/'))
+    assert len(bodies) == 4
+    assert s3.downloads == 4
+    assert sorted(cache._index) == [f"{BUCKET}/log_data/2.json",
+                                    f"{BUCKET}/log_data/3.json"]
+    assert len(list((tmp_path / 'objects').iterdir())) == 2
+
+    assert cache.get(BUCKET, 'log_data/3.json') == b"x" * 100
+    assert cache.get(BUCKET, 'log_data/0.json') == b"x" * 100
+    assert sorted(cache._index) == [f"{BUCKET}/log_data/0.json",
+                                    f"{BUCKET}/log_data/3.json"]
+
+
+def test_index_is_saved_when_the_consumer_stops_early(s3, tmp_path):
+    cache = S3Cache(tmp_path, max_bytes=10**6, workers=2, s3=s3)
+    objects = cache.iter_objects(BUCKET, 'log_data/')
+    next(objects)
+    objects.close()
+
+    assert s3.downloads == 2
+
+    reopened = S3Cache(tmp_path, max_bytes=10**6, s3=s3)
+    assert len(dict(reopened.iter_objects(BUCKET, 'log_data/'))) == 4
+    assert s3.downloads == 4
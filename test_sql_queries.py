@@ -0,0 +1,205 @@
+import configparser
+import datetime
+import itertools
+import re
+import pytest
+import sql_queries
+from sql_queries import Query,\
+                        queries,\
+                        create_table_queries,\
+                        staging_events_table_create,\
+                        staging_songs_table_create,\
+                        staging_events_hash,\
+                        user_table_create,\
+                        user_table_insert,\
+                        quarantine_insert,\
+                        top_artists_in_year,\
+                        top_songs_for_gender,\
+                        execute
+
+HOUR = 3600 * 1000
+
+
+def stage_events(cur, events):
+    """Replace the staged events by (user_id, level, ts) tuples."""
+    cur.execute("TRUNCATE TABLE staging_events;")
+    for session_id, (user_id, level, ts) in enumerate(events):
+        cur.execute("INSERT INTO staging_events (userId, firstName, "
+                    "lastName, gender, level, ts, sessionId, itemInSession) "
+                    "VALUES (%s, 'Lily', 'Koch', 'F', %s, %s, %s, 0);",
+                    (user_id, level, ts, session_id))
+
+
+def load_users(cur, events):
+    stage_events(cur, events)
+    execute(cur, user_table_insert, dialect='postgres')
+    cur.execute("SELECT user_id, level, valid_from, valid_to, is_current "
+                "FROM users ORDER BY user_id, valid_from;")
+    return cur.fetchall()
+
+
+def assert_valid_history(rows):
+    """Versions of a user must be contiguous with one current version."""
+    for user_id, versions in itertools.groupby(rows, key=lambda row: row[0]):
+        versions = list(versions)
+        for version, successor in zip(versions, versions[1:]):
+            assert version[3] == successor[2]
+            assert not version[4]
+        assert versions[-1][3] is None
+        assert versions[-1][4]
+
+
+@pytest.fixture
+def users(postgres):
+    conn, cur = postgres
+    execute(cur, staging_events_table_create, dialect='postgres')
+    execute(cur, user_table_create, dialect='postgres')
+    return cur
+
+
+def test_reload_without_changes_keeps_users(users):
+    events = [(1, 'free', 1 * HOUR), (1, 'free', 2 * HOUR),
+              (2, 'paid', 1 * HOUR)]
+    first = load_users(users, events)
+    assert [row[:2] for row in first] == [(1, 'free'), (2, 'paid')]
+    assert_valid_history(first)
+    assert load_users(users, events) == first
+
+
+def test_several_changes_in_one_load_do_not_overlap(users):
+    load_users(users, [(1, 'free', 1 * HOUR)])
+    rows = load_users(users, [(1, 'paid', 2 * HOUR),
+                              (1, 'paid', 3 * HOUR),
+                              (1, 'free', 4 * HOUR),
+                              (2, 'free', 2 * HOUR),
+                              (2, 'paid', 3 * HOUR)])
+    assert [row[:2] for row in rows] == [(1, 'free'), (1, 'paid'),
+                                         (1, 'free'), (2, 'free'),
+                                         (2, 'paid')]
+    assert_valid_history(rows)
+
+
+def test_events_in_the_same_millisecond_give_one_version(users):
+    rows = load_users(users, [(1, 'free', 1 * HOUR), (1, 'paid', 1 * HOUR)])
+    assert [row[:2] for row in rows] == [(1, 'paid')]
+    assert_valid_history(rows)
+
+
+def test_events_older_than_the_current_version_are_discarded(users):
+    first = load_users(users, [(1, 'paid', 2 * HOUR)])
+    assert load_users(users, [(1, 'free', 1 * HOUR)]) == first
+
+
+# QUERY REGISTRY
+
+class FakeConnection:
+    pass
+
+
+class FakeCursor:
+    """Record the statements sent to a connection."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = []
+
+    def execute(self, sql, args=None):
+        self.statements.append((sql, args))
+
+
+def test_registry_names_every_query():
+    assert queries['top_artists_in_year'] is top_artists_in_year
+    assert top_artists_in_year.name == 'top_artists_in_year'
+    assert all(query.name == name for name, query in queries.items())
+    assert not hasattr(sql_queries, '_name')
+    assert not hasattr(sql_queries, '_query')
+
+
+def test_bind_converts_strings_to_the_declared_type():
+    assert top_artists_in_year.bind(year='2018') == [2018]
+    assert top_songs_for_gender.bind(gender='F') == ['F']
+    # Values that are not strings are passed on unchanged.
+    assert top_songs_for_gender.bind(gender=5) == [5]
+    args = quarantine_insert.bind(table_name='staging_events',
+                                  filename='s3://bucket/log.json',
+                                  line_number='3',
+                                  colname='ts',
+                                  err_reason='Invalid int value.',
+                                  raw_line='{',
+                                  quarantined_at='2018-11-01T20:57:10')
+    assert args[2] == 3
+    assert args[6] == datetime.datetime(2018, 11, 1, 20, 57, 10)
+
+
+def test_bind_rejects_unknown_missing_and_invalid_parameters():
+    with pytest.raises(TypeError, match="no parameters \\['month'\\]"):
+        top_artists_in_year.bind(year=2018, month=11)
+    with pytest.raises(TypeError, match="needs parameter 'year'"):
+        top_artists_in_year.bind()
+    with pytest.raises(ValueError):
+        top_artists_in_year.bind(year='last year')
+
+
+def test_parameters_require_prepare():
+    with pytest.raises(ValueError):
+        Query("SELECT $1;", params=[('value', 'INTEGER')])
+
+
+def test_render_fills_in_config_values():
+    config = configparser.ConfigParser()
+    config.read_dict({'IAM_ROLE': {'ARN': 'arn:aws:iam::1:role/dwh'}})
+    query = Query("COPY t FROM 's3://b' IAM_ROLE '{ARN}';")
+    assert query.config_keys == ('ARN',)
+    assert query.render(config) == \
+        "COPY t FROM 's3://b' IAM_ROLE 'arn:aws:iam::1:role/dwh';"
+    with pytest.raises(ValueError, match="Unknown dialect"):
+        query.render(config, dialect='mysql')
+
+
+@pytest.mark.parametrize('query', create_table_queries,
+                         ids=lambda query: query.name)
+def test_create_tables_render_for_postgres(query):
+    sql = query.render(dialect='postgres')
+    assert not re.search(r"DISTKEY|SORTKEY|DISTSTYLE|PRIMARY KEY|"
+                         r"IDENTITY\s*\(", sql)
+    assert sql.count('(') == sql.count(')')
+    assert query.render() == query.sql
+
+
+def test_create_tables_run_on_postgres(postgres):
+    conn, cur = postgres
+    for query in create_table_queries:
+        execute(cur, query, dialect='postgres')
+    execute(cur, staging_events_hash, dialect='postgres')
+    cur.execute("INSERT INTO songplays (event_hash, start_time, user_id, "
+                "song_id, artist_id, session_id) "
+                "VALUES ('h1', now(), 1, 'S1', 'A1', '1') "
+                "RETURNING songplay_id;")
+    assert cur.fetchone() == (1,)
+
+
+def test_execute_prepares_once_per_connection():
+    connection = FakeConnection()
+    first, second = FakeCursor(connection), FakeCursor(connection)
+    execute(first, top_artists_in_year, year='2018')
+    execute(second, top_artists_in_year, year=2017)
+    execute(second, 'top_artists_in_year', year=2016)
+
+    prepares = [sql for sql, args in first.statements + second.statements
+                if sql.startswith('PREPARE')]
+    assert len(prepares) == 1
+    assert prepares[0].startswith("PREPARE top_artists_in_year (INTEGER) AS")
+    assert first.statements[1] == ("EXECUTE top_artists_in_year (%s)", [2018])
+    assert second.statements == [("EXECUTE top_artists_in_year (%s)", [2017]),
+                                 ("EXECUTE top_artists_in_year (%s)", [2016])]
+
+    other = FakeCursor(FakeConnection())
+    execute(other, top_artists_in_year, year=2018)
+    assert other.statements[0][0].startswith("PREPARE")
+
+
+def test_execute_sends_unprepared_queries_as_plain_sql():
+    cursor = FakeCursor(FakeConnection())
+    execute(cursor, staging_songs_table_create, dialect='postgres')
+    assert cursor.statements == [
+        (staging_songs_table_create.render(dialect='postgres'), None)]